@@ -14,12 +14,23 @@ if sys.version_info < (3, 12):
     sys.exit(f"Error: This script requires Python 3.12 or later. Found: {sys.version}")
 
 try:
+    import atexit
+    import copy
+    import functools
     import hashlib
+    import json
+    import os
+    import threading
     import requests
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.request import ACCEPT_ENCODING
+    from urllib3.util.retry import Retry
     from pathlib import Path
     from urllib.parse import urljoin, urlparse
-    from bs4 import BeautifulSoup, SoupStrainer
-    import lxml
+    import lxml.html
+    from lxml import etree
+    from lxml.cssselect import CSSSelector, LxmlTranslator
 except ImportError as e:
     # This error indicates install.sh failed to install dependencies correctly.
     print(f"Error: Required Python package missing: {e}", file=sys.stderr)
@@ -33,10 +44,18 @@ OUTPUT_FILE = "postgis_manual_single.html"
 # Use a subdirectory within the script's location for downloads
 DOWNLOAD_DIR = Path(__file__).parent / "postgis_docs_download"
 MAX_DEPTH = 1 # How many levels of links to follow and inline
+MAX_WORKERS = 8 # Parallel downloads (kept below the session's connection pool size)
+REVALIDATE_CACHE = False # Re-check cached pages with conditional GETs (ETag/Last-Modified) instead of trusting them
+VALIDATORS_FILENAME = "cache_validators.json" # Sidecar in DOWNLOAD_DIR: URL -> ETag/Last-Modified
 EXCLUDE_SELECTORS = [
     '.navheader', '.navfooter', 'img[alt="Edit this page"]', 'script',
     'link[rel="stylesheet"]', 'table.nav', '.editsection', 'a.ulink' # Exclude external links explicitly if needed
 ]
+# Main content containers, tried in order of preference before falling back to <body>
+MAIN_CONTENT_SELECTORS = [
+    'div[role="main"], section[role="main"]', 'div.chapter, section.chapter', 'div.refentry, section.refentry',
+    'div.sect1, section.sect1', 'div.article, section.article'
+]
 # CSS to make the final document somewhat readable
 CSS_OVERRIDE = """
 <style>
@@ -71,72 +90,181 @@ CSS_OVERRIDE = """
 </style>
 """
 
-processed_urls = set()
+# One pooled session so every page reuses the same keep-alive connection
+SESSION = requests.Session()
+# ACCEPT_ENCODING only lists codings urllib3 can decode here (adds br/zstd when those packages exist)
+SESSION.headers.update({"User-Agent": "postgis-manual-downloader", "Accept-Encoding": ACCEPT_ENCODING})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+atexit.register(SESSION.close)
+
+# Compiled once; CSSSelector translates to XPath up front so matching runs in C
+_MAIN_CONTENT_SEL = CSSSelector(", ".join(MAIN_CONTENT_SELECTORS)) # All candidates in one walk, document order
+# Per-element tests ranking a candidate by which MAIN_CONTENT_SELECTORS entry it matches
+_MAIN_CONTENT_RANKS = [etree.XPath(LxmlTranslator().css_to_xpath(selector, prefix='self::')) for selector in MAIN_CONTENT_SELECTORS]
+_EXCLUDE_SEL = CSSSelector(", ".join(EXCLUDE_SELECTORS)) # One combined selector, one tree walk
+# Comments are dropped while parsing so they never enter the tree; huge_tree lifts libxml2's
+# size/depth limits for the largest reference pages. Parsers aren't thread-safe: main thread only.
+_HTML_PARSER = lxml.html.HTMLParser(remove_comments=True, huge_tree=True)
+_URL_UNSAFE_CHARS = str.maketrans('', '', '\t\r\n') # urlsplit drops these anywhere in a URL
+# Cleaned pages depend on the selectors too, so editing them invalidates the parse cache
+_SELECTORS_KEY = hashlib.blake2b(repr((MAIN_CONTENT_SELECTORS, EXCLUDE_SELECTORS)).encode('utf-8'), digest_size=8).hexdigest()
+
+processed_pages = {} # URL -> processed main content Element, each page is processed once
 downloaded_files = {} # Store URL -> Path mapping
+downloaded_files_lock = threading.Lock() # download_resource runs on worker threads
+cached_files = {} # Filename -> Path for everything in DOWNLOAD_DIR, saves a stat() per lookup
+cache_validators = {} # URL -> {"etag": ..., "last_modified": ...} from the last full download
+page_depths = {} # URL -> shallowest link depth from the TOC, filled by prefetch_pages
+parsed_leaf_pages = {} # URL -> cleaned main content (serialised) for pages at MAX_DEPTH
 internal_domain = urlparse(BASE_URL).netloc
+base_path = urlparse(BASE_URL).path
+internal_prefix = internal_domain + base_path # Absolute internal URLs start with this after the scheme
 
 def setup_environment():
-    """Create download directory if it doesn't exist."""
+    """Create download directory if it doesn't exist and index its contents."""
     DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    cached_files.update((p.name, p) for p in DOWNLOAD_DIR.iterdir())
+    if VALIDATORS_FILENAME in cached_files:
+        try:
+            cache_validators.update(json.loads(cached_files[VALIDATORS_FILENAME].read_text(encoding='utf-8')))
+        except (OSError, ValueError) as e:
+            print(f"Warning: Ignoring unreadable {VALIDATORS_FILENAME}: {e}", file=sys.stderr)
     print(f"Using download cache directory: {DOWNLOAD_DIR}")
 
+def save_cache_validators():
+    """Persist ETag/Last-Modified values so later runs can revalidate cached pages cheaply."""
+    try:
+        (DOWNLOAD_DIR / VALIDATORS_FILENAME).write_text(json.dumps(cache_validators, indent=1), encoding='utf-8')
+    except OSError as e:
+        print(f"Warning: Could not save {VALIDATORS_FILENAME}: {e}", file=sys.stderr)
+
+@functools.lru_cache(maxsize=4096)
 def generate_filename(url):
-    """Create unique, safe filename from URL using MD5 hash."""
+    """Create unique, safe filename from URL using a short BLAKE2b hash."""
     parsed = urlparse(url)
     path_key = parsed.path.strip('/') or "index"
     if parsed.query:
         path_key += "?" + parsed.query
     if parsed.fragment:
         path_key += "#" + parsed.fragment
-    safe_hash = hashlib.md5(path_key.encode('utf-8')).hexdigest()[:16]
+    safe_hash = hashlib.blake2b(path_key.encode('utf-8'), digest_size=8).hexdigest()
     name_part = Path(parsed.path).stem or "page"
     safe_name = "".join(c if c.isalnum() else '_' for c in name_part)[:30]
     return f"{safe_name}_{safe_hash}.html"
 
-def is_internal_link(base_url, href):
-    """Check if link points to documentation content within the same base path."""
-    if not href or href.startswith('#') or href.startswith('mailto:') or href.startswith('javascript:'):
-        return False
-    abs_url = urljoin(base_url, href)
+def resolve_internal_link(base_url, href):
+    """Return the absolute URL if href points to documentation content within the base path, else None.
+
+    base_url is always a page of the manual itself, so plain relative hrefs (by far
+    the most common kind) are joined with string operations; anything unusual
+    goes through urljoin/urlparse.
+    """
+    href = (href or '').strip().translate(_URL_UNSAFE_CHARS)
+    if not href or href.startswith(('#', 'mailto:', 'javascript:')):
+        return None
+    if href.startswith('?'):
+        return _internal_or_none(urljoin(base_url, href))
+    page_url = base_url.partition('#')[0].partition('?')[0]
+    return _resolve_in_dir(page_url[:page_url.rfind('/') + 1], href)
+
+@functools.lru_cache(maxsize=4096) # Keyed on the page's directory, so hrefs repeated across pages hit
+def _resolve_in_dir(page_dir, href):
+    """Resolve href against the directory page_dir (ending in '/') for resolve_internal_link."""
+    if href.startswith(('https://', 'http://')):
+        return href if href.partition('//')[2].startswith(internal_prefix) else None
+    if ':' not in href and not href.startswith(('/', '.')) and '/.' not in href: # Dot segments need urljoin
+        return page_dir + href
+    return _internal_or_none(urljoin(page_dir, href))
+
+def _internal_or_none(abs_url):
+    """Return abs_url if it lies on the internal domain under base_path, else None."""
     parsed_abs = urlparse(abs_url)
     if parsed_abs.netloc and parsed_abs.netloc != internal_domain:
-        return False
-    base_path = urlparse(BASE_URL).path
+        return None
     if not parsed_abs.path.startswith(base_path):
-        return False
-    return True
+        return None
+    return abs_url
+
+def _keep_cached_copy(url, cached_path):
+    """Record cached_path as the download of url and return it (None if there is no cached copy).
+
+    Used for cache hits and whenever revalidating a cached page fails, so a
+    good copy already on disk is never dropped in favour of nothing.
+    """
+    if cached_path is None:
+        return None
+    with downloaded_files_lock:
+        downloaded_files[url] = cached_path
+    return cached_path
 
 def download_resource(url):
     """Download resource if not already downloaded. Returns file path or None."""
-    if url in downloaded_files:
-        return downloaded_files[url]
-    filepath = DOWNLOAD_DIR / generate_filename(url)
-    if filepath.exists():
+    with downloaded_files_lock:
+        if url in downloaded_files:
+            return downloaded_files[url]
+    filename = generate_filename(url)
+    cached_path = cached_files.get(filename)
+    validators = cache_validators.get(url) if cached_path else None
+    if cached_path and not (REVALIDATE_CACHE and validators):
         print(f"Cache hit: Using existing file for {url}")
-        downloaded_files[url] = filepath
-        return filepath
+        return _keep_cached_copy(url, cached_path)
 
-    print(f"Downloading: {url}")
+    headers = {}
+    if validators:
+        print(f"Revalidating: {url}")
+        if validators.get('etag'): headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'): headers['If-Modified-Since'] = validators['last_modified']
+    else:
+        print(f"Downloading: {url}")
+    filepath = DOWNLOAD_DIR / filename
+    part_path = filepath.with_name(filepath.name + '.part')
     try:
-        response = requests.get(url, timeout=20)
-        response.raise_for_status()
-        if 'text/html' not in response.headers.get('Content-Type', ''):
-            print(f"Warning: Skipping non-HTML content at {url} ({response.headers.get('Content-Type')})", file=sys.stderr)
-            return None
-        content = response.text
-        if not content.strip().startswith('<') or not content.strip().endswith('>'):
-             print(f"Warning: Content from {url} doesn't look like HTML. Skipping.", file=sys.stderr)
-             return None
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(content)
-        downloaded_files[url] = filepath
+        # Stream the raw (gzip-decoded) bytes straight to disk; lxml detects the charset when parsing
+        with SESSION.get(url, timeout=20, stream=True, headers=headers) as response:
+            if response.status_code == 304:
+                print(f"Cache hit: {url} not modified")
+                return _keep_cached_copy(url, cached_path)
+            response.raise_for_status()
+            if 'text/html' not in response.headers.get('Content-Type', ''):
+                print(f"Warning: Skipping non-HTML content at {url} ({response.headers.get('Content-Type')})", file=sys.stderr)
+                return _keep_cached_copy(url, cached_path)
+            chunks = response.iter_content(chunk_size=64 * 1024)
+            first_chunk = b''
+            for chunk in chunks: # Chunked responses can open with whitespace-only chunks
+                first_chunk += chunk
+                if chunk.strip(): break
+            last_chunk = first_chunk
+            if not first_chunk.lstrip().startswith(b'<'):
+                 print(f"Warning: Content from {url} doesn't look like HTML. Skipping.", file=sys.stderr)
+                 return _keep_cached_copy(url, cached_path)
+            with open(part_path, 'wb') as f:
+                f.write(first_chunk)
+                for chunk in chunks:
+                    f.write(chunk)
+                    if chunk.strip(): last_chunk = chunk
+            if not last_chunk.rstrip().endswith(b'>'):
+                 print(f"Warning: Content from {url} doesn't look like HTML. Skipping.", file=sys.stderr)
+                 return _keep_cached_copy(url, cached_path)
+        part_path.replace(filepath) # Only complete downloads ever become cache hits
+        with downloaded_files_lock:
+            downloaded_files[url] = filepath
+            cached_files[filename] = filepath
+            if 'ETag' in response.headers or 'Last-Modified' in response.headers:
+                cache_validators[url] = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+            else:
+                cache_validators.pop(url, None) # Validators of the previous copy no longer apply
         return filepath
     except requests.exceptions.RequestException as e:
         print(f"Error downloading {url}: {e}", file=sys.stderr)
-        return None
+        return _keep_cached_copy(url, cached_path)
     except Exception as e:
         print(f"Error processing download for {url}: {e}", file=sys.stderr)
-        return None
+        return _keep_cached_copy(url, cached_path)
+    finally:
+        part_path.unlink(missing_ok=True)
 
 def get_toc_structure(base_url):
     """Extract table of contents structure from the main index page."""
@@ -148,22 +276,21 @@ def get_toc_structure(base_url):
 
     toc = []
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            strainer = SoupStrainer('div', class_='toc')
-            soup = BeautifulSoup(f.read(), 'lxml', parse_only=strainer)
-        toc_div = soup.find('div', class_='toc')
-        if not toc_div:
+        # Read-only extraction, no mutation needed
+        tree = lxml.html.parse(str(filepath), _HTML_PARSER).getroot()
+        toc_divs = tree.cssselect('div.toc')
+        if not toc_divs:
              print("Warning: Could not find <div class='toc'> in index.html.", file=sys.stderr)
              return []
-        for item in toc_div.select(':scope > ul > li, :scope > ol > li'):
-            link = item.find('a', href=True)
-            if link:
-                href = link['href']
+        for item in toc_divs[0].cssselect(':scope > ul > li, :scope > ol > li'):
+            link = item.find('.//a[@href]')
+            if link is not None:
+                href = link.get('href')
                 if not href or href.startswith('#'):
                     continue
-                abs_url = urljoin(index_url, href)
-                if is_internal_link(index_url, href):
-                    title = link.get_text(strip=True) or f"Untitled Section ({href})"
+                abs_url = resolve_internal_link(index_url, href)
+                if abs_url:
+                    title = link.text_content().strip() or f"Untitled Section ({href})"
                     toc.append({"url": abs_url, "title": title, "id": f"section_{len(toc) + 1}"})
     except Exception as e:
         print(f"Error parsing TOC from {filepath}: {e}", file=sys.stderr)
@@ -172,119 +299,241 @@ def get_toc_structure(base_url):
          print("Warning: No TOC entries found. Check TOC selectors and index page structure.", file=sys.stderr)
     return toc
 
-def process_content(url, depth=0):
-    """Recursively process HTML content, expanding internal links."""
-    if url in processed_urls: return None
-    if depth > MAX_DEPTH:
-        print(f"Max depth ({MAX_DEPTH}) reached, not expanding: {url}")
+def extract_main_content(url, filepath):
+    """Parse a downloaded page and return its main content with excluded elements removed."""
+    tree = lxml.html.parse(str(filepath), _HTML_PARSER).getroot() # Parses straight from the file, no intermediate str
+    main_content, best_rank = None, len(_MAIN_CONTENT_RANKS)
+    for candidate in _MAIN_CONTENT_SEL(tree):
+        for rank, matches in enumerate(_MAIN_CONTENT_RANKS[:best_rank]):
+            if matches(candidate):
+                main_content, best_rank = candidate, rank
+                break
+        if best_rank == 0: break
+    if main_content is None:
+        print(f"Warning: Could not find main content container in {url}. Processing full body.", file=sys.stderr)
+        main_content = tree.find('body')
+        if main_content is None: main_content = tree
+        main_content.tag = 'div' # Gets nested in the combined document, so it can't stay a <body>
+
+    # The combined selector yields each match once, in document order, so no dedup is needed;
+    # the parent check skips anything already detached
+    for element in _EXCLUDE_SEL(main_content):
+         if element.getparent() is not None: element.drop_tree() # drop_tree keeps the trailing text
+    return main_content
+
+def _serialize_content(main_content):
+    """Serialise cleaned main content as HTML, so <style>/<script> text survives unescaped."""
+    return lxml.html.tostring(main_content, with_tail=False)
+
+def _deserialize_content(data):
+    """Rebuild main content serialised by _serialize_content, with the same parser limits as the source page."""
+    return lxml.html.fragment_fromstring(data, parser=_HTML_PARSER)
+
+def load_main_content(url, filepath):
+    """Return the cleaned main content of a page, reusing the on-disk parse cache when valid.
+
+    The cleaned (pre-expansion) content is stored next to the page as
+    <name>.clean.html, headed by the SHA-256 of the source HTML it came from
+    (plus a key for the selectors used); a match skips the selector and
+    exclusion work entirely.
+    """
+    filepath = Path(filepath)
+    clean_path = filepath.with_suffix('.clean.html')
+    with open(filepath, 'rb') as f:
+        hash_line = f"<!-- sha256:{hashlib.file_digest(f, 'sha256').hexdigest()} selectors:{_SELECTORS_KEY} format:html -->\n".encode('ascii')
+    try:
+        with open(clean_path, 'rb') as f:
+            if f.readline() == hash_line:
+                return _deserialize_content(f.read())
+    except (OSError, etree.LxmlError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"Warning: Ignoring unreadable parse cache {clean_path}: {e}", file=sys.stderr)
+
+    main_content = extract_main_content(url, filepath)
+    part_path = clean_path.with_name(clean_path.name + '.part')
+    try:
+        with open(part_path, 'wb') as f:
+            f.write(hash_line)
+            f.write(_serialize_content(main_content))
+        part_path.replace(clean_path)
+    except OSError as e:
+        print(f"Warning: Could not write parse cache {clean_path}: {e}", file=sys.stderr)
+        part_path.unlink(missing_ok=True)
+    return main_content
+
+def iter_expandable_links(url, main_content):
+    """Yield (link, absolute URL) for internal links in main_content that point to another page."""
+    for link in list(main_content.iterfind('.//a[@href]')): # Snapshot: callers replace links while iterating
+        if link.getparent() is None: continue
+        href = link.get('href')
+        abs_url = resolve_internal_link(url, href)
+        if not abs_url: continue
+        target_url_base, has_fragment, _ = abs_url.partition('#')
+        if has_fragment and target_url_base == url.partition('#')[0]: continue # Anchor within this page
+        yield link, abs_url
+
+def prefetch_pages(urls):
+    """Download the given pages and every page they link to (up to MAX_DEPTH) in parallel.
+
+    Pages are only link-scanned, not expanded, so all network I/O happens here
+    and process_content later works purely from the local cache. Each page is
+    scanned as soon as its download finishes and its links are queued right
+    away, so parsing overlaps the downloads still in flight. Records the
+    shallowest depth each page was reached at in page_depths; a page is never
+    downloaded by two threads at once.
+    """
+    page_depths.update(dict.fromkeys(urls, 0))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        pending = {pool.submit(download_resource, url): url for url in dict.fromkeys(urls)}
+        in_flight = set(pending.values())
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = pending.pop(future)
+                in_flight.discard(url)
+                depth = page_depths[url] # May have dropped while the download was running
+                filepath = future.result()
+                if not filepath or depth == MAX_DEPTH: continue
+                try:
+                    main_content = load_main_content(url, filepath)
+                except Exception as e:
+                    print(f"Warning: Could not scan {url} for links: {e}", file=sys.stderr)
+                    continue
+                for _, abs_url in iter_expandable_links(url, main_content):
+                    # Rescan pages reached again at a shallower depth; one still downloading
+                    # just picks up the new depth when it finishes
+                    if depth + 1 < page_depths.get(abs_url, MAX_DEPTH + 1):
+                        page_depths[abs_url] = depth + 1
+                        if abs_url not in in_flight:
+                            in_flight.add(abs_url)
+                            pending[pool.submit(download_resource, abs_url)] = abs_url
+
+def _parse_page(url, filepath_str):
+    """Process-pool worker: return the cleaned main content of a page as bytes, or None on error."""
+    try:
+        return _serialize_content(load_main_content(url, filepath_str))
+    except Exception as e:
+        print(f"Warning: Could not parse {url} in worker: {e}", file=sys.stderr)
         return None
 
-    processed_urls.add(url)
+def parse_leaf_pages():
+    """Parse pages that are only ever reached at MAX_DEPTH across all CPU cores.
+
+    Leaf pages are never expanded, so their whole processing is the CPU-bound
+    parse + clean step, which is independent per page. Results are kept in
+    parsed_leaf_pages for process_content to pick up.
+    """
+    leaf_urls = [url for url, depth in page_depths.items() if depth == MAX_DEPTH and downloaded_files.get(url)]
+    if not leaf_urls: return
+    print(f"Parsing {len(leaf_urls)} leaf pages in parallel...")
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        filepaths = [str(downloaded_files[url]) for url in leaf_urls]
+        parsed_leaf_pages.update(zip(leaf_urls, pool.map(_parse_page, leaf_urls, filepaths, chunksize=8)))
+
+def process_content(url, depth):
+    """Process one page, inlining the already-processed pages it links to one level deeper."""
     filepath = downloaded_files.get(url)
-    if not filepath or not filepath.exists():
-        print(f"Warning: File path not found or doesn't exist for {url}. Skipping processing.", file=sys.stderr)
+    if not filepath:
+        print(f"Warning: No downloaded file for {url}. Skipping processing.", file=sys.stderr)
         return None
 
     print(f"Processing (depth {depth}): {url}")
     try:
-        with open(filepath, 'r', encoding='utf-8') as f: content = f.read()
-        strainer = SoupStrainer(['div', 'section'], attrs={'role': 'main', 'class': ['chapter', 'refentry', 'sect1', 'article']})
-        soup = BeautifulSoup(content, 'lxml', parse_only=strainer)
-        main_content = soup.find(['div', 'section'], attrs={'role': 'main'}) \
-                    or soup.find(['div', 'section'], class_='chapter') \
-                    or soup.find(['div', 'section'], class_='refentry') \
-                    or soup.find(['div', 'section'], class_='sect1') \
-                    or soup.find(['div', 'section'], class_='article') \
-                    or soup.body
-        if not main_content:
-            print(f"Warning: Could not find main content container in {url}. Processing full body.", file=sys.stderr)
-            soup_full = BeautifulSoup(content, 'lxml')
-            main_content = soup_full.body or soup_full
-            if not main_content: return None
-
-        elements_to_remove = []
-        for selector in EXCLUDE_SELECTORS:
-            try: elements_to_remove.extend(main_content.select(selector))
-            except Exception as e: print(f"Warning: Error selecting '{selector}' in {url}: {e}", file=sys.stderr)
-        for element in set(elements_to_remove):
-             if element and element.parent: element.decompose()
-
-        links_to_process = main_content.find_all('a', href=True)
-        for link in links_to_process:
-            if not link.parent: continue
-            href = link['href']
-            if not is_internal_link(url, href): continue
-            abs_url = urljoin(url, href)
-            current_url_base = url.split('#')[0]
-            target_url_base = abs_url.split('#')[0]
-            if current_url_base == target_url_base and '#' in abs_url: continue
-
-            linked_filepath = download_resource(abs_url)
-            if not linked_filepath: continue
-
-            processed_linked_content = process_content(abs_url, depth + 1)
-            if processed_linked_content:
-                # Must create tags using the soup object from *this* level of recursion
-                wrapper_soup = BeautifulSoup('', 'lxml') # Need a factory for new tags
-                wrapper = wrapper_soup.new_tag('div', **{'class': 'expanded-content'})
-                source_note = wrapper_soup.new_tag('div', **{'class': 'source-link'})
-                source_note.string = f"↪ Content from: {abs_url}"
-                wrapper.append(source_note)
-                # Append the processed content (which is a Tag object)
-                # We need to parse the string representation if it came from a different soup
-                wrapper.append(BeautifulSoup(str(processed_linked_content), 'lxml').contents[0])
-
-                parent = link.parent
-                try:
-                    if parent and parent.name in ['p', 'li'] and len(parent.get_text(strip=True)) == len(link.get_text(strip=True)):
-                        parent.replace_with(wrapper)
-                    else:
-                        link.replace_with(wrapper)
-                except Exception as replace_err:
-                     print(f"Warning: Could not replace link/parent with wrapper for {abs_url} in {url}: {replace_err}", file=sys.stderr)
-                     # Fallback: append after link if replace fails
-                     try: link.insert_after(wrapper)
-                     except: pass # Ignore if insert fails too
-
-        return main_content # Return the modified Tag object
+        if parsed_leaf_pages.get(url):
+            return _deserialize_content(parsed_leaf_pages[url])
+        main_content = load_main_content(url, filepath)
+        if depth == MAX_DEPTH: return main_content # Links on leaf pages are left as plain links
+
+        inlined = set() # Inline each target once per page; later links to it stay plain links
+        for link, abs_url in iter_expandable_links(url, main_content):
+            # Only pages one level down are inlined, which also rules out cycles
+            if page_depths.get(abs_url) != depth + 1 or abs_url in inlined: continue
+            linked_content = processed_pages.get(abs_url)
+            if linked_content is None: continue
+            inlined.add(abs_url)
+
+            wrapper = lxml.html.Element('div', {'class': 'expanded-content'})
+            source_note = lxml.html.Element('div', {'class': 'source-link'})
+            source_note.text = f"↪ Content from: {abs_url}"
+            wrapper.append(source_note)
+            # Every referencing page gets its own copy; deepcopy is a C-level tree copy, no re-parse
+            linked_copy = copy.deepcopy(linked_content)
+            linked_copy.tail = None
+            wrapper.append(linked_copy)
+
+            parent = link.getparent()
+            try:
+                if parent.tag in ['p', 'li'] and parent.getparent() is not None \
+                        and len(parent.text_content().strip()) == len(link.text_content().strip()):
+                    target = parent
+                else:
+                    target = link
+                wrapper.tail = target.tail # replace() drops the replaced element's trailing text
+                target.getparent().replace(target, wrapper)
+            except Exception as replace_err:
+                 print(f"Warning: Could not replace link/parent with wrapper for {abs_url} in {url}: {replace_err}", file=sys.stderr)
+                 # Fallback: append after link if replace fails
+                 try: link.addnext(wrapper)
+                 except: pass # Ignore if insert fails too
+
+        return main_content # Return the modified Element
     except FileNotFoundError:
         print(f"Error: File not found during processing: {filepath}", file=sys.stderr)
         return None
     except Exception as e:
         print(f"Error processing content of {url} from {filepath}: {e}", file=sys.stderr)
-        error_soup = BeautifulSoup("", "lxml")
-        error_div = error_soup.new_tag('div', style="color: red; border: 1px solid red; padding: 10px;")
-        error_div.string = f"[Error processing content from {url}: {e}]"
-        return error_div # Return a placeholder tag
-
-def build_manual(toc):
-    """Construct the final single HTML document from processed content."""
-    final_soup = BeautifulSoup("<!DOCTYPE html><html><head><meta charset='UTF-8'><title>PostGIS Manual (Combined)</title></head><body></body></html>", 'html.parser')
-    head, body = final_soup.head, final_soup.body
-    style_tag = final_soup.new_tag('style'); style_tag.string = CSS_OVERRIDE; head.append(style_tag)
-
-    toc_container = final_soup.new_tag('div', **{'class': 'toc'})
-    toc_title = final_soup.new_tag('h1'); toc_title.string = "PostGIS Manual - Table of Contents"; toc_container.append(toc_title)
-    toc_list = final_soup.new_tag('ul')
+        error_div = lxml.html.Element('div', style="color: red; border: 1px solid red; padding: 10px;")
+        error_div.text = f"[Error processing content from {url}: {e}]"
+        return error_div # Return a placeholder element
+
+def process_pages():
+    """Process every prefetched page once, deepest level first.
+
+    Working bottom-up means the pages a page links to are already processed
+    when it is, so expansion is a lookup in processed_pages instead of a
+    recursive call. A level is dropped once the level above has copied it.
+    """
+    for depth in range(MAX_DEPTH, -1, -1):
+        for url, page_depth in page_depths.items():
+            if page_depth != depth or not downloaded_files.get(url): continue # Failed downloads were already reported
+            content = process_content(url, depth)
+            if content is not None: processed_pages[url] = content
+        if depth < MAX_DEPTH:
+            for url in [url for url in processed_pages if page_depths[url] == depth + 1]:
+                del processed_pages[url]
+
+def build_manual(toc, out):
+    """Serialise the final single HTML document from the processed pages to out.
+
+    Expects parse_leaf_pages and process_pages to have run already. Sections
+    are serialised and written one at a time, without pretty-printing, so the
+    combined manual never has to exist as a single string in memory. out is a
+    binary file: lxml encodes straight to UTF-8 bytes.
+    """
+    out.write(b"<!DOCTYPE html>\n<html><head><meta charset='UTF-8'><title>PostGIS Manual (Combined)</title>")
+    out.write(CSS_OVERRIDE.encode('utf-8')) # CSS_OVERRIDE carries its own <style> tag
+    out.write(b"</head><body>\n")
+
+    toc_container = lxml.html.Element('div', {'class': 'toc'})
+    toc_title = etree.SubElement(toc_container, 'h1'); toc_title.text = "PostGIS Manual - Table of Contents"
+    toc_list = etree.SubElement(toc_container, 'ul')
     for entry in toc:
-        item = final_soup.new_tag('li'); link = final_soup.new_tag('a', href=f"#{entry['id']}"); link.string = entry['title']; item.append(link); toc_list.append(item)
-    toc_container.append(toc_list); body.append(toc_container)
+        item = etree.SubElement(toc_list, 'li'); link = etree.SubElement(item, 'a', href=f"#{entry['id']}"); link.text = entry['title']
+    out.write(lxml.html.tostring(toc_container, encoding='utf-8'))
 
-    processed_urls.clear() # Reset for the main build phase
     for entry in toc:
         url, title, section_id = entry['url'], entry['title'], entry['id']
-        content_tag = process_content(url, depth=0) # Start recursion
-        if content_tag:
-            header = final_soup.new_tag('h1', id=section_id); header.string = title; body.append(header)
-            # Append the processed tag, ensuring it belongs to *this* soup instance
-            body.append(BeautifulSoup(str(content_tag), 'lxml').contents[0])
-            body.append(final_soup.new_tag('hr'))
+        content_elem = processed_pages.get(url)
+        header = lxml.html.Element('h1', id=section_id); header.text = title
+        out.write(lxml.html.tostring(header, encoding='utf-8'))
+        if content_elem is not None:
+            out.write(lxml.html.tostring(content_elem, encoding='utf-8', with_tail=False))
         else:
             print(f"Warning: No content generated for TOC entry: {title} ({url})", file=sys.stderr)
-            missing_header = final_soup.new_tag('h1', id=section_id); missing_header.string = title; body.append(missing_header)
-            missing_note = final_soup.new_tag('p', style="color: orange;"); missing_note.string = f"[Content for this section could not be processed or was empty]"; body.append(missing_note)
-            body.append(final_soup.new_tag('hr'))
-    return final_soup.prettify()
+            missing_note = lxml.html.Element('p', style="color: orange;"); missing_note.text = f"[Content for this section could not be processed or was empty]"
+            out.write(lxml.html.tostring(missing_note, encoding='utf-8'))
+        out.write(b"\n<hr>\n")
+    out.write(b"</body></html>\n")
 
 def main():
     """Main execution function."""
@@ -293,14 +542,21 @@ def main():
     if not toc: sys.exit("Failed to build Table of Contents. Exiting.")
     print(f"Found {len(toc)} top-level TOC entries.")
     print("Pre-downloading main chapter pages listed in TOC...")
-    toc_urls = {entry['url'] for entry in toc}
-    for url in toc_urls: download_resource(url)
+    toc_urls = list(dict.fromkeys(entry['url'] for entry in toc))
+    prefetch_pages(toc_urls)
+    save_cache_validators()
     print("Processing chapters and expanding internal links (up to MAX_DEPTH)...")
-    manual_html = build_manual(toc)
+    parse_leaf_pages()
+    process_pages()
+    # Write beside the output and rename, so a failed run leaves any previous manual intact
+    part_path = Path(OUTPUT_FILE + '.part')
     try:
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f: f.write(manual_html)
+        # Large buffer: build_manual issues many small per-section writes
+        with open(part_path, 'wb', buffering=1 << 20) as f: build_manual(toc, f)
+        part_path.replace(OUTPUT_FILE)
         print(f"\nSuccess! Combined manual saved to: {OUTPUT_FILE}")
     except IOError as e:
+        part_path.unlink(missing_ok=True)
         print(f"\nError writing final output file {OUTPUT_FILE}: {e}", file=sys.stderr)
         sys.exit(1)
 